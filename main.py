@@ -1,13 +1,36 @@
 #!/usr/bin/env python3
 
 import sys
-import pickle
+import struct
 import argparse
+import numpy as np
+from numba import njit
 from enum import IntEnum, auto
 from prompt_toolkit import prompt
 
 STACK_MAGIC = 0x535441434b
-STACK_VERSION = 1.0
+STACK_VERSION = 3.0
+# magic, version, instruction count; followed by the opcode, operand and
+# jump arrays of the linked program, each one after the other
+STACK_HEADER = struct.Struct('<QdI')
+# stack slots reserved on top of what a program is known to need, and in
+# place of it when its depth can grow without bound; Vm.execute grows the
+# stack further if such a program actually runs out of room
+STACK_HEADROOM = 16
+STACK_CAPACITY = 1024
+
+# errors run() reports back, as it cannot raise with the VM state intact
+STACK_UNDERFLOW = 1
+# the op at ip needs more stack than was allocated; Vm.execute grows the
+# stack and resumes there
+STACK_OVERFLOW = 2
+# run() gave back control after RUN_BUDGET jumps, so Python gets a chance
+# to deliver KeyboardInterrupt to a program that never halts
+STACK_YIELD = 3
+RUN_BUDGET = 1 << 20
+# run() popped a value for DUMP and left it at stack[sp] for Python to
+# print; printing from nopython mode crashes when a signal interrupts it
+STACK_DUMP = 4
 
 class Op(IntEnum):
     # stack
@@ -24,163 +47,393 @@ class Op(IntEnum):
     ELSE = auto()
     WHILE = auto()
     END = auto()
-    COUNT = auto()
 
     # others
     DUMP = auto()
 
-class Vm:
-    def __init__(self, program=[], stack=[]):
-        self.program = program
-        self.stack = stack
-        self.ip = 0
-
-    def execute(self):
-        while self.ip < len(self.program):
-            self.execute_op()
-    
-    def current_op(self):
-        return self.program[self.ip]
+    # only emitted by the linker
+    PUSH_ADD = auto()
+    PUSH_EQUALS = auto()
+    JMP = auto()
+    JZ = auto()
+    HALT = auto()
+    COUNT = auto()
 
-    def skip_until(self, op):
-        while self.current_op() != op:
-            self.ip += 1
+KEYWORDS = {
+    '+': Op.ADD,
+    '.': Op.DUMP,
+    '=': Op.EQUALS,
+    'if': Op.IF,
+    'else': Op.ELSE,
+    'while': Op.WHILE,
+    'end': Op.END,
+}
+
+# blocks are lowered to plain jumps, an END closing an if is dropped
+LOWERED_BLOCKS = {
+    Op.IF: Op.JZ,
+    Op.ELSE: Op.JMP,
+    Op.WHILE: Op.JZ,
+    Op.END: Op.JMP,
+}
+
+# keyed by every op the linker emits, which are the only ones run() handles
+STACK_EFFECTS = {
+    Op.PUSH: 1,
+    Op.ADD: -1,
+    Op.EQUALS: -1,
+    Op.DUMP: -1,
+    Op.PUSH_ADD: 0,
+    Op.PUSH_EQUALS: 0,
+    Op.JMP: 0,
+    Op.JZ: -1,
+    Op.HALT: 0,
+}
+
+FUSED_PUSH = {
+    Op.ADD: Op.PUSH_ADD,
+    Op.EQUALS: Op.PUSH_EQUALS,
+}
+
+def display_value(x):
+    """Values live as floats on the stack; show integral ones as ints."""
+    return int(x) if x.is_integer() else x
+
+@njit(cache=True)
+def run(opcodes, operands, jumps, stack, sp, ip, budget):
+    """Execute linked code from `ip` on a preallocated `stack` of depth `sp`.
+
+    The code must end with a HALT, which is what stops the loop instead of
+    a bounds check on every instruction. Returns the final instruction
+    pointer and stack depth, plus STACK_UNDERFLOW or STACK_OVERFLOW if the
+    op at that pointer could not run, leaving the stack as it was before it,
+    STACK_DUMP right after a DUMP, or STACK_YIELD once `budget` jumps have
+    been taken without halting.
+    """
+    # handles every op but IF, ELSE, WHILE and END, which the linker lowers
+    assert Op.COUNT == 14, "unexhaustive handling of operations"
 
-    def execute_op(self):
-        assert Op.COUNT == 8, "unexhaustive handling of operations"
+    while True:
+        op = opcodes[ip]
+        if op == Op.HALT:
+            break
 
-        op = self.current_op()
         # stack
-        if op == Op.PUSH:
-            self.ip += 1
-            self.stack.append(self.current_op())
+        elif op == Op.PUSH:
+            if sp == len(stack):
+                return ip, sp, STACK_OVERFLOW
+            stack[sp] = operands[ip]
+            sp += 1
+            ip += 1
 
         # arithmetics
         elif op == Op.ADD:
-            b = self.stack.pop()
-            a = self.stack.pop()
-            self.stack.append(a + b)
+            if sp < 2:
+                return ip, sp, STACK_UNDERFLOW
+            sp -= 1
+            stack[sp - 1] = stack[sp - 1] + stack[sp]
+            ip += 1
 
         # boolean
         elif op == Op.EQUALS:
-            b = self.stack.pop()
-            a = self.stack.pop()
-            self.stack.append(a == b)
-
-        # blocks
-        elif op == Op.IF:
-            if not Op.END in self.program[self.ip:]:
-                raise Exception('if op requires an end')
-
-            cond = self.stack.pop()
-            if cond:
-                self.ip += 1
-                while self.current_op() != Op.END:
-                    if self.current_op() == Op.ELSE:
-                        self.skip_until(Op.END)
-                    else: 
-                        self.execute_op()
-            else:
-                while self.current_op() != Op.END:
-                    self.ip += 1
-                    if self.current_op() == Op.ELSE:
-                        self.ip += 1
-                        while self.current_op() != Op.END:
-                            self.execute_op()
-        elif op == Op.ELSE:
-            raise Exception('else op requires an if')
-        elif op == Op.WHILE:
-            if not Op.END in self.program[self.ip:]:
-                raise Exception('while op requires an end')
-
-            cond = self.stack.pop()
-            self.ip += 1
-            while_ip = self.ip
-            while cond:
-                if self.current_op() == Op.END:
-                    self.ip = while_ip
-                self.execute_op()
-            self.skip_until(Op.END)
-        elif op == Op.END:
-            raise Exception('end op should close an if or else block')
+            if sp < 2:
+                return ip, sp, STACK_UNDERFLOW
+            sp -= 1
+            stack[sp - 1] = 1.0 if stack[sp - 1] == stack[sp] else 0.0
+            ip += 1
+
+        # superinstructions
+        elif op == Op.PUSH_ADD:
+            if sp < 1:
+                return ip, sp, STACK_UNDERFLOW
+            stack[sp - 1] = stack[sp - 1] + operands[ip]
+            ip += 1
+        elif op == Op.PUSH_EQUALS:
+            if sp < 1:
+                return ip, sp, STACK_UNDERFLOW
+            stack[sp - 1] = 1.0 if stack[sp - 1] == operands[ip] else 0.0
+            ip += 1
+
+        # jumps
+        elif op == Op.JZ:
+            if sp < 1:
+                return ip, sp, STACK_UNDERFLOW
+            sp -= 1
+            ip = ip + 1 if stack[sp] else jumps[ip]
+            # only jumps can keep a program from reaching HALT
+            budget -= 1
+            if budget == 0:
+                return ip, sp, STACK_YIELD
+        elif op == Op.JMP:
+            ip = jumps[ip]
+            budget -= 1
+            if budget == 0:
+                return ip, sp, STACK_YIELD
 
         # others
         elif op == Op.DUMP:
-            x = self.stack.pop()
-            print(x)
+            if sp < 1:
+                return ip, sp, STACK_UNDERFLOW
+            sp -= 1
+            return ip + 1, sp, STACK_DUMP
 
         else:
-            assert False, "unreachable"
+            raise Exception('unreachable')
+    return ip, sp, 0
+
+def link_blocks(program):
+    """Match every block op of a lexed program with its jump target.
+
+    `program` is a list of (op, value) pairs as returned by `lex`.
+
+    Returns a dict mapping the index of each IF, ELSE, WHILE and of each END
+    closing a WHILE to the index execution continues at when that op jumps.
+    An END closing an IF or ELSE never jumps, so it has no entry.
+    """
+    jumps = {}
+    blocks = []
+    open_block = blocks.append
+    close_block = blocks.pop
+    for ip, (op, _) in enumerate(program):
+        if op == Op.IF or op == Op.WHILE:
+            open_block(ip)
+        elif op == Op.ELSE:
+            if not blocks or program[blocks[-1]][0] != Op.IF:
+                raise Exception('else op requires an if')
+            jumps[close_block()] = ip + 1
+            open_block(ip)
+        elif op == Op.END:
+            if not blocks:
+                raise Exception('end op should close an if or else block')
+            block_ip = close_block()
+            if program[block_ip][0] == Op.WHILE:
+                jumps[ip] = block_ip + 1
+            jumps[block_ip] = ip + 1
+
+    if blocks:
+        if program[blocks[-1]][0] == Op.WHILE:
+            raise Exception('while op requires an end')
+        raise Exception('if op requires an end')
+
+    return jumps
+
+def max_stack_depth(opcodes, jumps):
+    """Deepest the stack gets above its starting depth running linked code.
+
+    Blocks only ever jump forward, except for the JMP closing a WHILE, so a
+    single pass in code order sees every way into an instruction before
+    the instruction itself, taking the deepest. A backward jump arriving
+    deeper than where it lands means the loop keeps growing the stack, in
+    which case no bound holds and None is returned.
+    """
+    opcodes = opcodes.tolist()
+    jumps = jumps.tolist()
+    effects = STACK_EFFECTS
+    depths = [None] * len(opcodes)
+    depths[0] = 0
+    deepest = 0
+    for ip, op in enumerate(opcodes):
+        depth = depths[ip]
+        if depth is None:
+            continue
+        if depth > deepest:
+            deepest = depth
+
+        depth += effects[op]
+        if op == Op.HALT:
+            continue
+        if op == Op.JMP or op == Op.JZ:
+            target = jumps[ip]
+            if target <= ip:
+                if depths[target] is None or depth > depths[target]:
+                    return None
+            elif depths[target] is None or depth > depths[target]:
+                depths[target] = depth
+        if op != Op.JMP:
+            if depths[ip + 1] is None or depth > depths[ip + 1]:
+                depths[ip + 1] = depth
+    return deepest
+
+class Vm:
+    def __init__(self, program=None, stack=None):
+        if stack is None:
+            stack = []
+        self.stack = np.array(stack, dtype=np.float64)
+        self.sp = len(stack)
+        self.load_from_program(program if program is not None else [])
+
+    def load_from_program(self, program):
+        """Link a lexed program to run next, keeping the current stack."""
+        self.program = program
+        self.ip = 0
+        self._link()
+        self._reserve_stack()
+
+    def _reserve_stack(self):
+        """Grow `stack` so the loaded code cannot overflow it.
+
+        The space is allocated once, up front, so `run` never resizes it
+        unless a loop keeps growing the stack, see `execute`.
+        """
+        depth = max_stack_depth(self.opcodes, self.jumps)
+        if depth is None:
+            depth = STACK_CAPACITY
+        self._grow_stack(self.sp + depth + STACK_HEADROOM)
+
+    def _grow_stack(self, capacity):
+        if len(self.stack) < capacity:
+            stack = np.empty(capacity, dtype=np.float64)
+            stack[:self.sp] = self.stack[:self.sp]
+            self.stack = stack
+
+    def _link(self):
+        """Lay the lexed program out as parallel typed arrays.
+
+        `opcodes[i]` is the op of the i-th instruction, `operands[i]` the
+        value it pushes and `jumps[i]` where it jumps to, with block targets
+        taken from `link_blocks`, translated to instruction indices. The
+        code is terminated by a HALT, which jumps past the end land on.
+
+        Block ops are lowered to JZ/JMP, see `LOWERED_BLOCKS`, so `run` never
+        sees IF, ELSE, WHILE or END. Constant additions are folded and a PUSH
+        feeding straight into ADD or EQUALS is fused with it, see
+        `FUSED_PUSH`. No block target can land inside such a sequence, since
+        targets always follow a block op.
+        """
+        program = self.program
+        jumps = link_blocks(program)
+        opcodes = []
+        operands = []
+        targets = []
+        code_ips = {}
+        emit_op = opcodes.append
+        emit_operand = operands.append
+        emit_target = targets.append
+        get_jump = jumps.get
+        n = len(program)
+        ip = 0
+        while ip < n:
+            op, value = program[ip]
+            code_ips[ip] = len(opcodes)
+            target = get_jump(ip)
+            ip += 1
+            if op == Op.PUSH:
+                # PUSH a PUSH b ADD folds into PUSH a+b
+                while (ip + 1 < n and program[ip][0] == Op.PUSH
+                       and program[ip + 1][0] == Op.ADD):
+                    value += program[ip][1]
+                    ip += 2
+                # PUSH a ADD and PUSH a EQUALS become a single instruction
+                if ip < n and program[ip][0] in FUSED_PUSH:
+                    op = FUSED_PUSH[program[ip][0]]
+                    ip += 1
+                emit_operand(value)
+            elif op in LOWERED_BLOCKS:
+                if target is None:
+                    continue
+                op = LOWERED_BLOCKS[op]
+                emit_operand(0)
+            else:
+                emit_operand(0)
+            emit_op(op)
+            emit_target(target)
+        code_ips[ip] = len(opcodes)
+        emit_op(Op.HALT)
+        emit_operand(0)
+        emit_target(None)
+
+        self.opcodes = np.array(opcodes, dtype=np.int8)
+        self.operands = np.array(operands, dtype=np.float64)
+        self.jumps = np.array([0 if target is None else code_ips[target]
+                               for target in targets],
+                              dtype=np.int64)
+
+    def execute(self):
+        while True:
+            self.ip, self.sp, error = run(self.opcodes, self.operands,
+                                          self.jumps, self.stack, self.sp,
+                                          self.ip, RUN_BUDGET)
+            if error == STACK_DUMP:
+                print(display_value(self.stack[self.sp].item()))
+            elif error == STACK_OVERFLOW:
+                self._grow_stack(2 * len(self.stack))
+            elif error != STACK_YIELD:
+                break
+        if error == STACK_UNDERFLOW:
+            raise Exception('stack underflow')
 
-        self.ip += 1
-    
     def load_from_file(self, file_path):
         with open(file_path, 'rb') as f:
-            magic = pickle.load(f)
-            if magic != STACK_MAGIC:
+            header = f.read(STACK_HEADER.size)
+            if len(header) != STACK_HEADER.size:
                 raise Exception('invalid file format')
 
-            version = pickle.load(f)
+            magic, version, n = STACK_HEADER.unpack(header)
+            if magic != STACK_MAGIC:
+                raise Exception('invalid file format')
             if version != STACK_VERSION:
                 raise Exception('invalid file version')
 
-            program = pickle.load(f)
-            self.program = program
+            opcodes = np.fromfile(f, dtype='<i1', count=n)
+            operands = np.fromfile(f, dtype='<f8', count=n)
+            jumps = np.fromfile(f, dtype='<i8', count=n)
+            if len(jumps) != n or n == 0 or opcodes[-1] != Op.HALT:
+                raise Exception('invalid file format')
+            # run() trusts the code it is given, so reject anything the
+            # linker could not have produced before it gets there
+            if not np.isin(opcodes, list(STACK_EFFECTS)).all():
+                raise Exception('invalid file format')
+            if ((jumps < 0) | (jumps >= n)).any():
+                raise Exception('invalid file format')
+
+            self.opcodes = opcodes.astype(np.int8)
+            self.operands = operands.astype(np.float64)
+            self.jumps = jumps.astype(np.int64)
+            self.ip = 0
+            self._reserve_stack()
 
     def save_to_file(self, file_path):
         with open(file_path, 'wb') as f:
-            pickle.dump(STACK_MAGIC, f)
-            pickle.dump(STACK_VERSION, f)
-            pickle.dump(self.program, f)
+            f.write(STACK_HEADER.pack(STACK_MAGIC, STACK_VERSION,
+                                      len(self.opcodes)))
+            f.write(self.opcodes.astype('<i1').tobytes())
+            f.write(self.operands.astype('<f8').tobytes())
+            f.write(self.jumps.astype('<i8').tobytes())
 
 def lex(code):
+    """Turn source code into a list of (op, value) pairs.
+
+    `value` is the literal a PUSH pushes and None for every other op.
+    """
     program = []
-    words = [word
-              for word in code.split(' ')
-              if len(word) > 0]
-    for word in words:
-        if word == '+':
-            program.append(Op.ADD)
-        elif word == '.':
-            program.append(Op.DUMP)
-        elif word == '=':
-            program.append(Op.EQUALS)
-        elif word == 'if':
-            program.append(Op.IF)
-        elif word == 'else':
-            program.append(Op.ELSE)
-        elif word == 'while':
-            program.append(Op.WHILE)
-        elif word == 'end':
-            program.append(Op.END)
-        else:
-            program.append(Op.PUSH)
-            try: 
-                program.append(int(word))
-            except ValueError:
-                try: 
-                    program.append(float(word))
-                except ValueError:
-                    raise Exception('unknown word: %s' % bytes(word, 'utf-8'))
+    emit = program.append
+    for word in code.split():
+        op = KEYWORDS.get(word)
+        if op is not None:
+            emit((op, None))
+            continue
+
+        # every value ends up as a float on the stack, so a single float()
+        # covers both integer and float literals
+        try:
+            value = float(word)
+        except ValueError:
+            raise Exception('unknown word: %s' % bytes(word, 'utf-8'))
+        emit((Op.PUSH, value))
     return program
 
 def lex_file(file_path):
     with open(file_path, 'r') as f:
-        lines = [line
-                 for line in f.read().split('\n')
-                 if len(line) > 0]
-        code = ' '.join(lines)
-        return lex(code)
+        return lex(f.read())
 
 def repl():
-    stack = []
+    vm = Vm()
     while True:
         try:
             line = prompt('> ')
-            program = lex(line)
-            vm = Vm(program, stack)
+            vm.load_from_program(lex(line))
             vm.execute()
-            print(vm.stack)
+            print([display_value(x) for x in vm.stack[:vm.sp].tolist()])
         except (KeyboardInterrupt, EOFError):
             exit(0)
         except Exception as e: